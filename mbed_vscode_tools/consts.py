@@ -2,6 +2,7 @@
 
 CMAKE_ROOTDIR_NAME = 'cmake_build'
 CMAKE_CONFFILE_NAME = 'mbed_config.cmake'
+CMAKE_LISTFILE_NAME = 'CMakeLists.txt'
 NINJA_BUILDFILE_NAME = 'build.ninja'
 VSCODE_CONFFILE_INDENT_LENGTH = 4
 VSCODE_DEFAULT_CONFENTRY_NAME = 'Mbed'
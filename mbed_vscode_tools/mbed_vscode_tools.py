@@ -1,59 +1,114 @@
 import click
+import itertools
 import pathlib
 import json
-import subprocess
-from . import consts
-from typing import Tuple, List
+import mmap
+import os
+import re
+import stat
+import tempfile
+from .consts import (
+    CMAKE_CONFFILE_NAME, CMAKE_LISTFILE_NAME, NINJA_BUILDFILE_NAME,
+    VSCODE_CONFFILE_INDENT_LENGTH, VSCODE_DEFAULT_CONFENTRY_NAME)
+from typing import Tuple, List, Optional
+
+# Flags are read from the first non-empty DEFINES/INCLUDES variables in build.ninja.
+_NINJA_FLAGS_VAR_RE = re.compile(rb'^[ \t]*(DEFINES|INCLUDES) = (.*)$', re.MULTILINE)
+
+# A define value may contain quoted spaces and backslash escapes
+# (e.g. -DMSG="\"a b\"" for an mbed string config).
+# Include paths (-I and -isystem) with spaces are quoted by cmake;
+# the quotes and the backslash escapes inside them are removed.
+_DEFINE_FLAG_RE = re.compile(r'(?:^|\s)-D((?:"(?:[^"\\]|\\.)*"|\\.|[^\s"\\])+)')
+_INCLUDE_FLAG_RE = re.compile(r'(?:^|\s)(?:-I|-isystem\s*)(?:"((?:[^"\\]|\\.)*)"|(\S+))')
+_BACKSLASH_ESCAPE_RE = re.compile(r'\\(.)')
+
+# cmake lists every file it read as implicit inputs of the statement regenerating
+# build.ninja (`build build.ninja: RERUN_CMAKE | <inputs>`), with ninja's $-escapes.
+_NINJA_RERUN_CMAKE_RE = re.compile(
+    rb'^build build\.ninja\b[^\n]*?: RERUN_CMAKE \|((?:\$[\s\S]|[^\n$])*)', re.MULTILINE)
+_NINJA_PATH_RE = re.compile(rb'(?:\$[^\n]|[^\s$])+')
+_NINJA_ESCAPE_RE = re.compile(rb'\$(.)')
+
+_UPDATE_DONE_BANNER = click.style('UPDATE DONE', fg='green', bold=True)
 
 
 def parse_includes_and_defines(ninja_build_file: pathlib.Path) -> Tuple[List[str], List[str]]:
     """Parse include paths and defines from build.ninja file."""
-    defines, includes = [], []
-    with ninja_build_file.open(mode='r') as file:
-        lines = file.readlines()
-        defines_done = False
-        includes_done = False
-        for line in lines:
-            line = line.strip()
-
-            # Parse defines
-            if not defines_done and line.startswith('DEFINES = '):
-                for define in line.split('-D')[1:]:  # Remove 'DEFINES = '
-                    define = define.strip()
-                    if define not in defines:
-                        defines.append(define)
-                defines_done = True
-
-            # Parse includes
-            if not includes_done and line.startswith('INCLUDES = '):
-                for include in line.split('-I')[1:]:  # Remove 'INCLUDES = '
-                    include = include.strip()
-                    if include not in includes:
-                        includes.append(include)
-                includes_done = True
-
-            # Termination
-            if defines_done and includes_done:
-                break
+    flags_lines = {}
+    with ninja_build_file.open(mode='rb') as file:
+        if os.fstat(file.fileno()).st_size > 0:  # An empty file can't be mmapped
+            with mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as buf:
+                for match in _NINJA_FLAGS_VAR_RE.finditer(buf):
+                    name, value = match.group(1), match.group(2).strip()
+                    if value and name not in flags_lines:
+                        flags_lines[name] = value.decode('utf-8')
+                        if len(flags_lines) == 2:  # Both found
+                            break
+    defines_line = flags_lines.get(b'DEFINES', '')
+    includes_line = flags_lines.get(b'INCLUDES', '')
+
+    # Parse defines and includes, removing duplicates in order
+    defines = list(dict.fromkeys(_DEFINE_FLAG_RE.findall(defines_line)))
+    includes = list(dict.fromkeys(
+        _BACKSLASH_ESCAPE_RE.sub(r'\1', quoted) if quoted else unquoted
+        for quoted, unquoted in _INCLUDE_FLAG_RE.findall(includes_line)))
+
     # Manually add one include
     # TODO: Should parse this automatically as well
-    includes.append(str(ninja_build_file.parent / '_deps' / 'greentea-client-src' / 'include'))
+    includes.append(str(ninja_build_file.parent.joinpath('_deps', 'greentea-client-src', 'include')))
     return (includes, defines)
 
 
+def _read_cmake_input_files(ninja_build_file: pathlib.Path) -> Optional[List[pathlib.Path]]:
+    """Read the files cmake generated build.ninja from. Return None if they aren't listed."""
+    with ninja_build_file.open(mode='rb') as file:
+        if os.fstat(file.fileno()).st_size == 0:  # An empty file can't be mmapped
+            return None
+        with mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as buf:
+            match = _NINJA_RERUN_CMAKE_RE.search(buf)
+            if match is None:
+                return None
+            inputs = _NINJA_PATH_RE.findall(match.group(1))
+    # Relative paths are relative to the build directory
+    return [
+        ninja_build_file.parent / os.fsdecode(_NINJA_ESCAPE_RE.sub(rb'\1', path))
+        for path in inputs]
+
+
+def is_build_ninja_up_to_date(
+        ninja_build_file: pathlib.Path,
+        *input_files: pathlib.Path) -> bool:
+    """Check if build.ninja exists and is newer than all the files cmake read
+    to generate it (as listed in build.ninja) and the given input files."""
+    try:
+        ninja_mtime = ninja_build_file.stat().st_mtime_ns
+        cmake_input_files = _read_cmake_input_files(ninja_build_file)
+        if cmake_input_files is None:  # Can't tell what cmake depends on
+            return False
+        return all(
+            ninja_mtime > f.stat().st_mtime_ns
+            for f in itertools.chain(input_files, cmake_input_files))
+    except FileNotFoundError:
+        return False
+
+
 def validate_vscode_conf_file(
         vscode_conf_file: pathlib.Path,
-        vscode_conf_entry: str) -> dict:
-    """Validate c_cpp_properties.json an return it as a dict."""
-    with vscode_conf_file.open(mode='r') as file:
-        try:
-            vscode_conf = json.load(file)
-        except json.JSONDecodeError:
-            raise Exception(
-                f'Invalid json file: {vscode_conf_file}')
-    n = len(list(filter(
-        lambda entry: entry['name'] == vscode_conf_entry,
-        vscode_conf['configurations'])))
+        vscode_conf_entry: str) -> Tuple[dict, int]:
+    """Validate c_cpp_properties.json and return it with the index of the config entry."""
+    try:
+        vscode_conf = json.loads(vscode_conf_file.read_bytes())
+    except json.JSONDecodeError:
+        raise Exception(
+            f'Invalid json file: {vscode_conf_file}')
+    n, index = 0, -1
+    for i, entry in enumerate(vscode_conf['configurations']):
+        if entry['name'] == vscode_conf_entry:
+            n += 1
+            index = i
+            if n > 1:  # Already invalid, no need to scan the rest
+                break
     if n < 1:  # No "Mbed" entry
         raise Exception(
             f'Could not find \"{vscode_conf_entry}\" config entry in your c_cpp_properties.json ({vscode_conf_file}).')
@@ -61,7 +116,32 @@ def validate_vscode_conf_file(
         raise Exception(
             f'More than two \"{vscode_conf_entry}\" config entries found in <{vscode_conf_file}>. '
             f'Leave one \"{vscode_conf_entry}\" entry and remove the others.')
-    return vscode_conf
+    return (vscode_conf, index)
+
+
+def save_vscode_conf_file(vscode_conf_file: pathlib.Path, vscode_conf: dict) -> bool:
+    """Save c_cpp_properties.json atomically. Return False if it's unchanged."""
+    content = json.dumps(
+        vscode_conf, indent=VSCODE_CONFFILE_INDENT_LENGTH,
+        ensure_ascii=False).encode('utf-8')
+    vscode_conf_file = vscode_conf_file.resolve()  # Write through a symlink
+    if vscode_conf_file.read_bytes() == content:
+        return False  # Don't touch the file not to trigger vscode reloading it
+    # Use a unique temp file so that concurrent runs don't clobber each other
+    fd, tmp_name = tempfile.mkstemp(
+        prefix=vscode_conf_file.name + '.', suffix='.tmp',
+        dir=str(vscode_conf_file.parent))
+    tmp_file = pathlib.Path(tmp_name)
+    try:
+        with os.fdopen(fd, 'wb') as file:
+            file.write(content)
+        os.chmod(tmp_file, stat.S_IMODE(vscode_conf_file.stat().st_mode))
+        os.replace(tmp_file, vscode_conf_file)
+    except BaseException:
+        if tmp_file.exists():
+            tmp_file.unlink()
+        raise
+    return True
 
 
 @click.group()
@@ -85,21 +165,25 @@ def cmd():
     type=click.Path(
         exists=True, file_okay=False, dir_okay=True,
         resolve_path=True),
-    default=pathlib.Path().cwd(), show_default=True,
+    default=None,
     help='Path to the mbed program directory root. '
          'If not specified, it\'s set to your current working directory.')
 @click.option(
     '--vscode-conf-entry',
-    type=str, default=consts.VSCODE_DEFAULT_CONFENTRY_NAME, show_default=True,
+    type=str, default=VSCODE_DEFAULT_CONFENTRY_NAME, show_default=True,
     help='Specify the target config entry of your c_cpp_properties.json.')
+@click.option(
+    '--force', is_flag=True,
+    help='Regenerate build.ninja even if it is up to date.')
 @click.option(
     '--verbose', is_flag=True,
     help='Show complete message logs.')
 def update(
         mbed_build_dir: str,
         vscode_conf_file: str,
-        mbed_program_dir: str,
+        mbed_program_dir: Optional[str],
         vscode_conf_entry: str,
+        force: bool,
         verbose: bool) -> None:
     """Update your c_cpp_properties.json.
 
@@ -112,15 +196,16 @@ def update(
     """
     mbed_build_dir: pathlib.Path = pathlib.Path(mbed_build_dir)
     vscode_conf_file: pathlib.Path = pathlib.Path(vscode_conf_file)
-    mbed_program_dir: pathlib.Path = pathlib.Path(mbed_program_dir)
+    mbed_program_dir: pathlib.Path = (
+        pathlib.Path.cwd() if mbed_program_dir is None else pathlib.Path(mbed_program_dir))
 
     # Check validity of c_cpp_properties.json
-    vscode_conf = validate_vscode_conf_file(vscode_conf_file, vscode_conf_entry)
+    vscode_conf, conf_entry_index = validate_vscode_conf_file(vscode_conf_file, vscode_conf_entry)
     if verbose:
         click.echo(f'-- No errros found in your c_cpp_properties.json')
 
     # Check if cmake configuration file exists
-    cmake_conf_file = mbed_build_dir / consts.CMAKE_CONFFILE_NAME
+    cmake_conf_file = mbed_build_dir / CMAKE_CONFFILE_NAME
     if not cmake_conf_file.exists():
         raise Exception(
             f'Could not find the cmake config file ({cmake_conf_file}). '
@@ -129,38 +214,60 @@ def update(
         click.echo(f'-- The cmake config file ({cmake_conf_file}) found.')
 
     # Generate build.ninja
-    ret = subprocess.run([
-        'cmake',
-        '-S', str(mbed_program_dir),
-        '-B', str(mbed_build_dir),
-        '-GNinja'], capture_output=True)
-    if ret.returncode != 0:
-        err = ret.stderr.decode('utf-8')
-        raise Exception(
-            'Failed to generate build.ninja for some reasons. '
-            f'Here\'s the error output from cmake >>\n{err}')
-    if verbose:
-        click.echo(f'-- Succeeded to generate build.ninja.')
+    ninja_build_file = mbed_build_dir / NINJA_BUILDFILE_NAME
+    if not force and is_build_ninja_up_to_date(
+            ninja_build_file,
+            cmake_conf_file,
+            mbed_program_dir / CMAKE_LISTFILE_NAME):
+        click.echo(
+            '-- build.ninja is up to date. Skipped cmake '
+            '(use --force to regenerate it).')
+    else:
+        import subprocess  # Only needed when cmake actually runs
+        with subprocess.Popen([
+                'cmake',
+                '-S', str(mbed_program_dir),
+                '-B', str(mbed_build_dir),
+                '-GNinja'],
+                stdout=None if verbose else subprocess.DEVNULL,
+                stderr=subprocess.PIPE) as proc:
+            err_lines = []
+            for line in proc.stderr:  # Stream stderr while cmake is running
+                if verbose:
+                    click.echo(line, nl=False, err=True)
+                else:
+                    err_lines.append(line)
+        if proc.returncode != 0:
+            if verbose:  # The error output has already been shown above
+                raise Exception(
+                    'Failed to generate build.ninja for some reasons. '
+                    'See the error output from cmake above.')
+            err = b''.join(err_lines).decode('utf-8')
+            raise Exception(
+                'Failed to generate build.ninja for some reasons. '
+                f'Here\'s the error output from cmake >>\n{err}')
+        if verbose:
+            click.echo(f'-- Succeeded to generate build.ninja.')
 
     # Get "Mbed" entry
-    conf_entry = next(filter(
-        lambda entry: entry['name'] == vscode_conf_entry,
-        vscode_conf['configurations']))
+    conf_entry = vscode_conf['configurations'][conf_entry_index]
 
     # Update "Mbed" entry
-    includes, defines = parse_includes_and_defines(mbed_build_dir / consts.NINJA_BUILDFILE_NAME)
+    includes, defines = parse_includes_and_defines(ninja_build_file)
+    click.echo(
+        f'-- {len(includes)} include paths parsed.\n'
+        f'-- {len(defines)} defines parsed.')
     conf_entry['includePath'] = includes
     conf_entry['defines'] = defines
-    click.echo(f'-- {len(includes)} include paths parsed.')
-    click.echo(f'-- {len(defines)} defines parsed.')
 
     # Save c_cpp_properties.json
-    with vscode_conf_file.open('w') as file:
-        json.dump(vscode_conf, file, indent=consts.VSCODE_CONFFILE_INDENT_LENGTH)
-    click.echo(f'-- Updated your c_cpp_properties.json.')
+    if save_vscode_conf_file(vscode_conf_file, vscode_conf):
+        click.echo(f'-- Updated your c_cpp_properties.json.')
+    else:
+        click.echo('-- No changes in your c_cpp_properties.json.')
 
     # Success
-    click.echo(click.style('UPDATE DONE', fg='green', bold=True))
+    click.echo(_UPDATE_DONE_BANNER)
 
 
 def main():
@@ -0,0 +1,176 @@
+import json
+import os
+import stat
+
+from click.testing import CliRunner
+
+from mbed_vscode_tools.mbed_vscode_tools import (
+    cmd, is_build_ninja_up_to_date, parse_includes_and_defines, save_vscode_conf_file)
+
+
+def _set_mtime(path, mtime_ns):
+    os.utime(str(path), ns=(mtime_ns, mtime_ns))
+
+
+def _make_mbed_program(tmp_path):
+    """Create an mbed program whose build.ninja is newer than all its cmake inputs."""
+    program_dir = tmp_path / 'program'
+    build_dir = program_dir / 'cmake_build'
+    (build_dir / 'sub dir').mkdir(parents=True)
+    (program_dir / 'CMakeLists.txt').write_text('')
+    (build_dir / 'sub dir' / 'CMakeLists.txt').write_text('')
+    (build_dir / 'mbed_config.cmake').write_text('')
+    ninja_build_file = build_dir / 'build.ninja'
+    ninja_build_file.write_bytes(
+        b'build CMakeFiles/app.dir/main.cpp.obj: CXX_COMPILER__app main.cpp\n'
+        b'  DEFINES = -DA=1\n'
+        b'  INCLUDES = -I/p/inc\n'
+        b'build build.ninja: RERUN_CMAKE | ' + bytes(program_dir / 'CMakeLists.txt') +
+        b' mbed_config.cmake sub$ dir/CMakeLists.txt\n'
+        b'  pool = console\n')
+    for path in [
+            program_dir / 'CMakeLists.txt',
+            build_dir / 'sub dir' / 'CMakeLists.txt',
+            build_dir / 'mbed_config.cmake']:
+        _set_mtime(path, 1_000_000_000)
+    _set_mtime(ninja_build_file, 2_000_000_000)
+    return program_dir, build_dir
+
+
+def test_parse_includes_and_defines_keeps_escaped_string_defines(tmp_path):
+    # Hand-written DEFINES/INCLUDES lines using the quoting cmake applies
+    # to string configs and paths with spaces (plus a duplicate define)
+    ninja_build_file = tmp_path / 'build.ninja'
+    ninja_build_file.write_bytes(
+        b'build CMakeFiles/app.dir/main.cpp.obj: CXX_COMPILER__app main.cpp\n'
+        b'  DEFINES = -DA=1 -DFOO=-Dbar -DMSG="\\"a b\\"" -DQ=\\"x\\" -DSP="a b" -DA=1\n'
+        b'  INCLUDES = -I/p/inc -I"/p/with space" -I/p/inc -I"/p/a\\"b" -isystem /p/sys\n')
+    includes, defines = parse_includes_and_defines(ninja_build_file)
+    assert defines == ['A=1', 'FOO=-Dbar', 'MSG="\\"a b\\""', 'Q=\\"x\\"', 'SP="a b"']
+    assert includes == [
+        '/p/inc', '/p/with space', '/p/a"b', '/p/sys',
+        str(tmp_path / '_deps' / 'greentea-client-src' / 'include')]
+
+
+def test_parse_includes_and_defines_accepts_empty_file(tmp_path):
+    ninja_build_file = tmp_path / 'build.ninja'
+    ninja_build_file.write_bytes(b'')
+    includes, defines = parse_includes_and_defines(ninja_build_file)
+    assert defines == []
+    assert includes == [str(tmp_path / '_deps' / 'greentea-client-src' / 'include')]
+
+
+def test_save_vscode_conf_file_keeps_mode_and_symlink(tmp_path):
+    real_file = tmp_path / 'real.json'
+    real_file.write_text('{}')
+    real_file.chmod(0o600)
+    vscode_conf_file = tmp_path / 'c_cpp_properties.json'
+    vscode_conf_file.symlink_to(real_file)
+    assert save_vscode_conf_file(vscode_conf_file, {'configurations': []})
+    assert vscode_conf_file.is_symlink()
+    assert json.loads(real_file.read_text()) == {'configurations': []}
+    assert stat.S_IMODE(real_file.stat().st_mode) == 0o600
+    assert not save_vscode_conf_file(vscode_conf_file, {'configurations': []})
+    assert sorted(p.name for p in tmp_path.iterdir()) == ['c_cpp_properties.json', 'real.json']
+
+
+def test_save_vscode_conf_file_leaves_other_temp_files_alone(tmp_path):
+    vscode_conf_file = tmp_path / 'c_cpp_properties.json'
+    vscode_conf_file.write_text('{}')
+    other_tmp_file = tmp_path / 'c_cpp_properties.json.tmp'  # e.g. from a concurrent run
+    other_tmp_file.write_text('other')
+    assert save_vscode_conf_file(vscode_conf_file, {'configurations': []})
+    assert other_tmp_file.read_text() == 'other'
+    assert sorted(p.name for p in tmp_path.iterdir()) == [
+        'c_cpp_properties.json', 'c_cpp_properties.json.tmp']
+
+
+def test_is_build_ninja_up_to_date(tmp_path):
+    program_dir, build_dir = _make_mbed_program(tmp_path)
+    assert is_build_ninja_up_to_date(
+        build_dir / 'build.ninja', build_dir / 'mbed_config.cmake')
+
+
+def test_is_build_ninja_up_to_date_without_build_ninja(tmp_path):
+    program_dir, build_dir = _make_mbed_program(tmp_path)
+    (build_dir / 'build.ninja').unlink()
+    assert not is_build_ninja_up_to_date(build_dir / 'build.ninja')
+
+
+def test_is_build_ninja_up_to_date_with_newer_input(tmp_path):
+    program_dir, build_dir = _make_mbed_program(tmp_path)
+    # An input only listed in build.ninja, e.g. a CMakeLists.txt in a subdirectory
+    _set_mtime(build_dir / 'sub dir' / 'CMakeLists.txt', 3_000_000_000)
+    assert not is_build_ninja_up_to_date(build_dir / 'build.ninja')
+
+
+def test_is_build_ninja_up_to_date_with_newer_given_input(tmp_path):
+    program_dir, build_dir = _make_mbed_program(tmp_path)
+    extra_file = tmp_path / 'extra.cmake'
+    extra_file.write_text('')
+    _set_mtime(extra_file, 3_000_000_000)
+    assert not is_build_ninja_up_to_date(build_dir / 'build.ninja', extra_file)
+
+
+def test_is_build_ninja_up_to_date_with_missing_input(tmp_path):
+    program_dir, build_dir = _make_mbed_program(tmp_path)
+    (build_dir / 'sub dir' / 'CMakeLists.txt').unlink()
+    assert not is_build_ninja_up_to_date(build_dir / 'build.ninja')
+
+
+def test_is_build_ninja_up_to_date_without_rerun_cmake_statement(tmp_path):
+    ninja_build_file = tmp_path / 'build.ninja'
+    ninja_build_file.write_bytes(b'  DEFINES = -DA=1\n')
+    assert not is_build_ninja_up_to_date(ninja_build_file)
+
+
+def test_update_runs_cmake_with_force(tmp_path, monkeypatch):
+    program_dir, build_dir = _make_mbed_program(tmp_path)
+    vscode_conf_file = tmp_path / 'c_cpp_properties.json'
+    vscode_conf_file.write_text(json.dumps({'configurations': [{'name': 'Mbed'}]}))
+    # A fake cmake leaving a mark when it runs
+    bin_dir = tmp_path / 'bin'
+    bin_dir.mkdir()
+    (bin_dir / 'cmake').write_text(f'#!/bin/sh\ntouch "{tmp_path}/cmake_ran"\n')
+    (bin_dir / 'cmake').chmod(0o755)
+    monkeypatch.setenv('PATH', f'{bin_dir}{os.pathsep}{os.environ["PATH"]}')
+    args = ['update', str(build_dir), str(vscode_conf_file), '--mbed-program-dir', str(program_dir)]
+
+    result = CliRunner().invoke(cmd, args)
+    assert result.exit_code == 0, result.output
+    assert 'build.ninja is up to date' in result.output
+    assert not (tmp_path / 'cmake_ran').exists()
+
+    result = CliRunner().invoke(cmd, args + ['--force'])
+    assert result.exit_code == 0, result.output
+    assert (tmp_path / 'cmake_ran').exists()
+
+
+def test_update_does_not_touch_unchanged_vscode_conf_file(tmp_path):
+    program_dir, build_dir = _make_mbed_program(tmp_path)
+    vscode_conf_file = tmp_path / 'c_cpp_properties.json'
+    vscode_conf = {'configurations': [{
+        'name': 'Mbed',
+        'includePath': ['/p/inc', str(build_dir / '_deps' / 'greentea-client-src' / 'include')],
+        'defines': ['A=1']}]}
+    vscode_conf_file.write_text(json.dumps(vscode_conf, indent=4))
+    _set_mtime(vscode_conf_file, 3_000_000_000)
+
+    result = CliRunner().invoke(cmd, [
+        'update', str(build_dir), str(vscode_conf_file),
+        '--mbed-program-dir', str(program_dir)])
+    assert result.exit_code == 0, result.output
+    assert '-- No changes in your c_cpp_properties.json.' in result.output
+    assert vscode_conf_file.stat().st_mtime_ns == 3_000_000_000
+
+    vscode_conf['configurations'][0]['defines'] = []
+    vscode_conf_file.write_text(json.dumps(vscode_conf, indent=4))
+    result = CliRunner().invoke(cmd, [
+        'update', str(build_dir), str(vscode_conf_file),
+        '--mbed-program-dir', str(program_dir)])
+    assert result.exit_code == 0, result.output
+    assert '-- Updated your c_cpp_properties.json.' in result.output
+    assert json.loads(vscode_conf_file.read_text()) == {'configurations': [{
+        'name': 'Mbed',
+        'includePath': ['/p/inc', str(build_dir / '_deps' / 'greentea-client-src' / 'include')],
+        'defines': ['A=1']}]}